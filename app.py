@@ -1,15 +1,26 @@
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import (
+    Flask,
+    Request,
+    Response,
+    request,
+    jsonify,
+    send_file,
+    render_template_string,
+    stream_with_context,
+)
 from werkzeug.utils import secure_filename
-import torch
 import os
 import io
 import base64
 from PIL import Image
 import uuid
 import threading
+import shutil
 import time
-from generator import Generator
-from upscaler import load_image, save_image
+import zipfile
+from journal import open_broker
+from planner import ImageTooLarge, configure_threads, read_dimensions
+import worker
 
 app = Flask(__name__)
 
@@ -18,8 +29,28 @@ DATA_DIR = os.environ.get("UPSCALED_DATA_DIR") or BASE_DIR
 UPLOAD_FOLDER = os.path.join(DATA_DIR, "uploads")
 OUTPUT_FOLDER = os.path.join(DATA_DIR, "outputs")
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+ARCHIVE_EXTENSIONS = {"zip"}
+MAX_BATCH_IMAGES = 500
+MAX_ARCHIVE_SIZE = 256 * 1024 * 1024
+STREAM_TIMEOUT = float(os.environ.get("UPSCALED_STREAM_TIMEOUT", "120"))
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+MAX_BATCH_CONTENT_LENGTH = int(
+    os.environ.get("UPSCALED_MAX_BATCH_UPLOAD_MB", "512")
+) * 1024 * 1024
+WORKER_THREADS = int(os.environ.get("UPSCALED_WORKERS", "1"))
 
+
+class UploadRequest(Request):
+    # Batch uploads carry many images, so they get their own, larger limit.
+    # Flask 2.3 has no per-request setter for this.
+    @property
+    def max_content_length(self):
+        if self.endpoint == "upscale_batch":
+            return MAX_BATCH_CONTENT_LENGTH
+        return super().max_content_length
+
+
+app.request_class = UploadRequest
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["OUTPUT_FOLDER"] = OUTPUT_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
@@ -29,7 +60,7 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 model = None
 model_loaded = False
-processing_status = {}
+broker = open_broker(DATA_DIR)
 
 
 def allowed_file(filename):
@@ -39,42 +70,131 @@ def allowed_file(filename):
 def load_model():
     global model, model_loaded
     try:
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        model = Generator(scale_factor=4).to(device)
-        model_path = os.path.join(BASE_DIR, "generator.pth")
-        model.load_state_dict(torch.load(model_path, map_location=device))
-        model.eval()
+        model = worker.load_model(os.path.join(BASE_DIR, "generator.pth"))
         model_loaded = True
-        print(f"Model loaded successfully on {device}!")
+        print(f"Model loaded successfully on {next(model.parameters()).device}!")
     except Exception as e:
         print(f"Error loading model: {e}")
         model_loaded = False
 
 
-def process_image_async(task_id, input_path, output_path):
-    global processing_status
-
-    try:
-        processing_status[task_id] = {"status": "processing", "progress": 0}
+def new_task(filename):
+    task_id = str(uuid.uuid4())
 
-        processing_status[task_id]["progress"] = 25
-        img_tensor = load_image(input_path).to(next(model.parameters()).device)
+    filename = secure_filename(filename)
+    input_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_{filename}")
 
-        processing_status[task_id]["progress"] = 50
-        with torch.no_grad():
-            sr_tensor = model(img_tensor)
+    output_filename = f"upscaled_{filename}"
+    output_path = os.path.join(
+        app.config["OUTPUT_FOLDER"], f"{task_id}_{output_filename}"
+    )
+    return task_id, input_path, output_path
 
-        processing_status[task_id]["progress"] = 75
-        save_image(sr_tensor, output_path)
 
-        processing_status[task_id] = {
-            "status": "completed",
-            "progress": 100,
+def enqueue_task(task_id, input_path, output_path, **extra):
+    broker.enqueue(
+        task_id,
+        {
+            "status": "queued",
+            "progress": 0,
+            "input_path": input_path,
             "output_path": output_path,
-        }
+            **extra,
+        },
+    )
 
-    except Exception as e:
-        processing_status[task_id] = {"status": "error", "progress": 0, "error": str(e)}
+
+def stage_batch(files, staged):
+    archive_size = 0
+    for file in files:
+        extension = file.filename.rsplit(".", 1)[-1].lower()
+        if extension in ARCHIVE_EXTENSIONS:
+            if not zipfile.is_zipfile(file.stream):
+                return jsonify({"error": f"Invalid archive: {file.filename}"}), 400
+            file.stream.seek(0)
+            with zipfile.ZipFile(file.stream) as archive:
+                entries = [
+                    info
+                    for info in archive.infolist()
+                    if not info.is_dir() and allowed_file(info.filename)
+                ]
+                archive_size += sum(info.file_size for info in entries)
+                if len(staged) + len(entries) > MAX_BATCH_IMAGES:
+                    return jsonify({"error": "Too many images in batch"}), 413
+                if archive_size > MAX_ARCHIVE_SIZE:
+                    return jsonify({"error": f"{file.filename} is too large"}), 413
+
+                for info in entries:
+                    filename = os.path.basename(info.filename)
+                    task_id, input_path, output_path = new_task(filename)
+                    staged.append((filename, task_id, input_path, output_path))
+                    with archive.open(info) as source, open(input_path, "wb") as target:
+                        shutil.copyfileobj(source, target)
+        elif allowed_file(file.filename):
+            if len(staged) >= MAX_BATCH_IMAGES:
+                return jsonify({"error": "Too many images in batch"}), 413
+            task_id, input_path, output_path = new_task(file.filename)
+            staged.append((file.filename, task_id, input_path, output_path))
+            file.save(input_path)
+        else:
+            return jsonify({"error": f"Invalid file type: {file.filename}"}), 400
+
+    if not staged:
+        return jsonify({"error": "No images found in upload"}), 400
+
+    for filename, _, input_path, _ in staged:
+        error = check_image(input_path, filename)
+        if error:
+            return error
+    return None
+
+
+def discard_staged(staged):
+    for _, _, input_path, _ in staged:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+
+
+class ZipStream(io.RawIOBase):
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def check_image(fp, filename):
+    try:
+        read_dimensions(fp)
+    except ImageTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except Exception:
+        return jsonify({"error": f"Invalid image: {filename}"}), 400
+    return None
+
+
+def accepting_jobs():
+    return model_loaded or WORKER_THREADS == 0
+
+
+def start_workers():
+    if not model_loaded:
+        return
+    configure_threads(WORKER_THREADS)
+    for _ in range(WORKER_THREADS):
+        thread = threading.Thread(
+            target=worker.run_worker, args=(broker, model), daemon=True
+        )
+        thread.start()
 
 
 HTML_TEMPLATE = """
@@ -612,12 +732,12 @@ def index():
 
 @app.route("/api/model-status")
 def model_status():
-    return jsonify({"loaded": model_loaded})
+    return jsonify({"loaded": accepting_jobs()})
 
 
 @app.route("/api/upscale", methods=["POST"])
 def upscale():
-    if not model_loaded:
+    if not accepting_jobs():
         return jsonify({"error": "Model not loaded"}), 500
 
     if "image" not in request.files:
@@ -630,39 +750,159 @@ def upscale():
     if not allowed_file(file.filename):
         return jsonify({"error": "Invalid file type"}), 400
 
-    task_id = str(uuid.uuid4())
+    error = check_image(file.stream, file.filename)
+    if error:
+        return error
+    file.stream.seek(0)
 
-    filename = secure_filename(file.filename)
-    input_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_{filename}")
+    task_id, input_path, output_path = new_task(file.filename)
     file.save(input_path)
+    enqueue_task(task_id, input_path, output_path)
 
-    output_filename = f"upscaled_{filename}"
-    output_path = os.path.join(
-        app.config["OUTPUT_FOLDER"], f"{task_id}_{output_filename}"
+    return jsonify({"task_id": task_id, "message": "Processing started"})
+
+
+@app.route("/api/upscale/batch", methods=["POST"])
+def upscale_batch():
+    if not accepting_jobs():
+        return jsonify({"error": "Model not loaded"}), 500
+
+    files = [file for file in request.files.getlist("images") if file.filename]
+    if not files:
+        return jsonify({"error": "No image files provided"}), 400
+
+    staged = []
+    try:
+        error = stage_batch(files, staged)
+    except zipfile.BadZipFile:
+        error = jsonify({"error": "Invalid archive"}), 400
+    except Exception:
+        discard_staged(staged)
+        raise
+    if error:
+        discard_staged(staged)
+        return error
+
+    batch_id = str(uuid.uuid4())
+    names = set()
+    task_ids = []
+    for filename, task_id, input_path, output_path in staged:
+        name = f"upscaled_{secure_filename(filename)}"
+        stem, dot, extension = name.rpartition(".")
+        suffix = 1
+        while name in names:
+            name = f"{stem}_{suffix}{dot}{extension}"
+            suffix += 1
+        names.add(name)
+
+        enqueue_task(task_id, input_path, output_path, batch_id=batch_id, name=name)
+        task_ids.append(task_id)
+
+    return jsonify(
+        {"batch_id": batch_id, "task_ids": task_ids, "message": "Processing started"}
     )
 
-    thread = threading.Thread(
-        target=process_image_async, args=(task_id, input_path, output_path)
+
+@app.route("/api/batch/<batch_id>/progress")
+def batch_progress(batch_id):
+    tasks = broker.batch(batch_id)
+    if not tasks:
+        return jsonify({"error": "Batch not found"}), 404
+
+    statuses = [state["status"] for state in tasks.values()]
+    pending = sum(status in ("queued", "processing") for status in statuses)
+    return jsonify(
+        {
+            "status": "processing" if pending else "completed",
+            "progress": sum(state["progress"] for state in tasks.values())
+            // len(tasks),
+            "total": len(tasks),
+            "completed": statuses.count("completed"),
+            "failed": statuses.count("error"),
+            "tasks": {
+                task_id: {
+                    "name": state["name"],
+                    "status": state["status"],
+                    "progress": state["progress"],
+                    **({"error": state["error"]} if "error" in state else {}),
+                }
+                for task_id, state in tasks.items()
+            },
+        }
     )
-    thread.start()
 
-    return jsonify({"task_id": task_id, "message": "Processing started"})
+
+@app.route("/api/batch/<batch_id>/download")
+def batch_download(batch_id):
+    if not broker.batch(batch_id):
+        return jsonify({"error": "Batch not found"}), 404
+
+    def generate():
+        stream = ZipStream()
+        written = set()
+        failed = []
+        updated_at = None
+        last_change = time.monotonic()
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as archive:
+            while True:
+                tasks = broker.batch(batch_id)
+                for task_id, state in tasks.items():
+                    if task_id in written or state["status"] in ("queued", "processing"):
+                        continue
+                    written.add(task_id)
+                    if state["status"] != "completed":
+                        failed.append(f"{state['name']}: {state.get('error', 'failed')}")
+                    elif not os.path.exists(state["output_path"]):
+                        failed.append(f"{state['name']}: output file is missing")
+                    else:
+                        archive.write(state["output_path"], state["name"])
+                        yield stream.drain()
+
+                if len(written) == len(tasks):
+                    break
+
+                # A batch queued behind other work makes no progress of its
+                # own, so only give up once no worker holds a live lease.
+                latest = broker.batch_updated_at(batch_id)
+                if latest != updated_at or broker.live_leases():
+                    updated_at = latest
+                    last_change = time.monotonic()
+                elif time.monotonic() - last_change > STREAM_TIMEOUT:
+                    unfinished = [
+                        state["name"]
+                        for task_id, state in tasks.items()
+                        if task_id not in written
+                    ]
+                    archive.writestr("unfinished.txt", "\n".join(unfinished) + "\n")
+                    break
+                time.sleep(worker.POLL_INTERVAL)
+
+            if failed:
+                archive.writestr("failed.txt", "\n".join(failed) + "\n")
+        yield stream.drain()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=upscaled_{batch_id}.zip"},
+    )
 
 
 @app.route("/api/progress/<task_id>")
 def progress(task_id):
-    if task_id not in processing_status:
+    task_status = broker.get(task_id)
+    if task_status is None:
         return jsonify({"error": "Task not found"}), 404
 
-    return jsonify(processing_status[task_id])
+    return jsonify(task_status)
 
 
 @app.route("/api/download/<task_id>")
 def download(task_id):
-    if task_id not in processing_status:
+    task_status = broker.get(task_id)
+    if task_status is None:
         return jsonify({"error": "Task not found"}), 404
 
-    task_status = processing_status[task_id]
     if task_status["status"] != "completed":
         return jsonify({"error": "Task not completed"}), 400
 
@@ -675,20 +915,23 @@ def download(task_id):
 
 @app.route("/api/cleanup/<task_id>", methods=["DELETE"])
 def cleanup(task_id):
-    if task_id in processing_status:
+    if broker.get(task_id) is not None:
         for folder in [app.config["UPLOAD_FOLDER"], app.config["OUTPUT_FOLDER"]]:
             for file in os.listdir(folder):
                 if file.startswith(task_id):
                     os.remove(os.path.join(folder, file))
+        shutil.rmtree(os.path.join(worker.CHECKPOINT_DIR, task_id), ignore_errors=True)
 
-        del processing_status[task_id]
+        broker.forget(task_id)
         return jsonify({"message": "Files cleaned up"})
 
     return jsonify({"error": "Task not found"}), 404
 
 
 if __name__ == "__main__":
-    load_model()
+    if WORKER_THREADS:
+        load_model()
+    start_workers()
 
     host = os.environ.get("UPSCALED_HOST", "127.0.0.1")
     port = int(os.environ.get("UPSCALED_PORT", "5000"))
@@ -0,0 +1,237 @@
+from abc import ABC, abstractmethod
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CLAIMABLE = "(status = 'queued' OR (status = 'processing' AND lease_until < ?))"
+
+
+class JobBroker(ABC):
+    @abstractmethod
+    def enqueue(self, task_id, state):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, task_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim(self, owner, lease_seconds, limit=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_batch(self, owner, lease_seconds, batch_id, limit):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update(self, task_id, owner, state):
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat(self, owner, task_ids, lease_seconds):
+        raise NotImplementedError
+
+    @abstractmethod
+    def batch(self, batch_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def batch_updated_at(self, batch_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def live_leases(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def forget(self, task_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Journal(JobBroker):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_id TEXT PRIMARY KEY, "
+            "status TEXT NOT NULL, "
+            "batch_id TEXT, "
+            "owner TEXT, "
+            "lease_until REAL NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "state TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_batch_id ON tasks (batch_id, status)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at)"
+        )
+
+    def enqueue(self, task_id, state):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO tasks "
+                "(task_id, status, batch_id, created_at, updated_at, state) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    task_id,
+                    state["status"],
+                    state.get("batch_id"),
+                    now,
+                    now,
+                    json.dumps(state),
+                ),
+            )
+
+    def get(self, task_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, owner, lease_seconds, limit=1):
+        return self._claim(owner, lease_seconds, limit)
+
+    def claim_batch(self, owner, lease_seconds, batch_id, limit):
+        return self._claim(owner, lease_seconds, limit, batch_id=batch_id, head=False)
+
+    def _claim(self, owner, lease_seconds, limit, batch_id=None, head=True):
+        now = time.time()
+        claimed = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if head:
+                    rows = self._conn.execute(
+                        f"SELECT task_id, batch_id, state FROM tasks WHERE {CLAIMABLE} "
+                        "ORDER BY created_at LIMIT 1",
+                        (now,),
+                    ).fetchall()
+                    claimed += self._take(rows, owner, lease_seconds, now)
+                    if rows:
+                        batch_id = rows[0][1]
+
+                if (claimed or not head) and len(claimed) < limit:
+                    rows = self._conn.execute(
+                        "SELECT task_id, batch_id, state FROM tasks "
+                        f"WHERE batch_id IS ? AND {CLAIMABLE} "
+                        "ORDER BY created_at LIMIT ?",
+                        (batch_id, now, limit - len(claimed)),
+                    ).fetchall()
+                    claimed += self._take(rows, owner, lease_seconds, now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def _take(self, rows, owner, lease_seconds, now):
+        claimed = []
+        for task_id, _, state in rows:
+            state = json.loads(state)
+            state.update(status="processing", progress=0)
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, owner = ?, lease_until = ?, "
+                "updated_at = ?, state = ? WHERE task_id = ?",
+                (
+                    "processing",
+                    owner,
+                    now + lease_seconds,
+                    now,
+                    json.dumps(state),
+                    task_id,
+                ),
+            )
+            claimed.append((task_id, state))
+        return claimed
+
+    def update(self, task_id, owner, state):
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET status = ?, updated_at = ?, state = ? "
+                "WHERE task_id = ? AND owner = ?",
+                (state["status"], time.time(), json.dumps(state), task_id, owner),
+            )
+        return cursor.rowcount > 0
+
+    def heartbeat(self, owner, task_ids, lease_seconds):
+        now = time.time()
+        held = []
+        with self._lock:
+            for task_id in task_ids:
+                cursor = self._conn.execute(
+                    "UPDATE tasks SET lease_until = ?, updated_at = ? "
+                    "WHERE task_id = ? AND owner = ? AND status = 'processing'",
+                    (now + lease_seconds, now, task_id, owner),
+                )
+                if cursor.rowcount:
+                    held.append(task_id)
+        return held
+
+    def batch(self, batch_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id, state FROM tasks WHERE batch_id = ? "
+                "ORDER BY created_at",
+                (batch_id,),
+            ).fetchall()
+        return {task_id: json.loads(state) for task_id, state in rows}
+
+    def batch_updated_at(self, batch_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(updated_at) FROM tasks WHERE batch_id = ?", (batch_id,)
+            ).fetchone()
+        return row[0]
+
+    def live_leases(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM tasks "
+                "WHERE status = 'processing' AND lease_until >= ?",
+                (time.time(),),
+            ).fetchone()
+        return row[0]
+
+    def forget(self, task_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+BACKENDS = {
+    "sqlite": lambda data_dir: Journal(os.path.join(data_dir, "jobs.db")),
+}
+
+
+def open_broker(data_dir, backend=None):
+    backend = backend or os.environ.get("UPSCALED_JOB_BACKEND", "sqlite")
+    if backend in BACKENDS:
+        return BACKENDS[backend](data_dir)
+
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown job backend: {backend}")
+    broker_class = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(broker_class, type) and issubclass(broker_class, JobBroker)):
+        raise TypeError(f"Job backend {backend} is not a JobBroker subclass")
+    return broker_class(data_dir)
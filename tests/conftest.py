@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PERF_RESULTS = []
+PROBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_probe.py")
+
+
+def peak_rss_mb(probe, size):
+    # RSS of the test process depends on whatever ran before, so each path is
+    # re-run alone in a fresh interpreter and its own high-water mark taken.
+    kind, *args = probe
+    try:
+        result = subprocess.run(
+            [sys.executable, PROBE, kind, *map(str, size), *map(str, args)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return round(json.loads(result.stdout)["path_peak_bytes"] / 2**20, 2)
+
+
+@pytest.fixture
+def measure():
+    def run(path, size, fn, probe):
+        start = time.perf_counter()
+        output = fn()
+        latency = time.perf_counter() - start
+        PERF_RESULTS.append(
+            {
+                "path": path,
+                "size": f"{size[0]}x{size[1]}",
+                "latency_ms": round(latency * 1000, 2),
+                "peak_rss_above_setup_mb": peak_rss_mb(probe, size),
+            }
+        )
+        return output
+
+    return run
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not PERF_RESULTS:
+        return
+
+    terminalreporter.section("inference paths")
+    terminalreporter.write_line(
+        f"{'path':<16} {'size':>8} {'latency':>13} "
+        f"{'peak RSS above setup, fresh process':>38}"
+    )
+    for result in PERF_RESULTS:
+        memory = result["peak_rss_above_setup_mb"]
+        terminalreporter.write_line(
+            f"{result['path']:<16} {result['size']:>8} "
+            f"{result['latency_ms']:>10.2f} ms "
+            f"{'-' if memory is None else memory:>35} MB"
+        )
+
+    report_path = os.environ.get("UPSCALED_PERF_REPORT")
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(PERF_RESULTS, f, indent=2)
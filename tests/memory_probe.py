@@ -0,0 +1,52 @@
+"""Run one inference path in a fresh interpreter and report its peak RSS.
+
+Usage: python memory_probe.py PATH WIDTH HEIGHT [ARG ...]
+
+Prints JSON with the process high-water mark after setup (torch, model and
+input) and how far running the path pushed it above that.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch  # noqa: E402
+
+from generator import Generator  # noqa: E402
+from upscaler import upscale_tiled  # noqa: E402
+
+PATHS = {
+    "reference": lambda model, image: model(image),
+    "batched": lambda model, image, count: model(torch.cat([image] * count)),
+    "tiled": lambda model, image, tile_size, overlap: upscale_tiled(
+        model, image, tile_size, overlap
+    ),
+}
+
+
+def max_rss_bytes():
+    # VmHWM belongs to this process image. ru_maxrss is not a substitute on
+    # Linux: it carries over the parent's high-water mark across exec.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("VmHWM not reported")
+
+
+def main(path, width, height, *args):
+    torch.manual_seed(0)
+    model = Generator(scale_factor=4).eval()
+    image = torch.rand(1, 3, int(height), int(width))
+
+    setup = max_rss_bytes()
+    with torch.no_grad():
+        PATHS[path](model, image, *map(int, args))
+    peak = max_rss_bytes()
+
+    print(json.dumps({"setup_peak_bytes": setup, "path_peak_bytes": peak - setup}))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
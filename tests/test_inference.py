@@ -0,0 +1,147 @@
+import math
+
+import pytest
+import torch
+
+from generator import Generator
+from planner import (
+    MEMORY_FRACTION,
+    TILE_SIZES,
+    estimate_tiled_bytes,
+    plan_job,
+    tile_overlap,
+)
+from upscaler import upscale_tiled
+
+SIZES = [(24, 24), (53, 37), (96, 64)]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = Generator(scale_factor=4).eval()
+    # Default BatchNorm gains of 1 let a random model damp long-range
+    # influence, which hides tile seams. Amplify it like a trained model.
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.weight.data.uniform_(2.5, 3.5)
+    return model
+
+
+def synthetic_image(width, height, seed):
+    generator = torch.Generator().manual_seed(seed)
+    ys = torch.linspace(0, 1, height).view(1, 1, height, 1)
+    xs = torch.linspace(0, 1, width).view(1, 1, 1, width)
+    xs, ys = xs.expand(1, 1, height, width), ys.expand(1, 1, height, width)
+    gradient = torch.cat([xs, ys, (xs + ys) / 2], dim=1)
+    noise = torch.rand(1, 3, height, width, generator=generator)
+    return (0.7 * gradient + 0.3 * noise).clamp(0, 1)
+
+
+def relative_error(reference, output):
+    return ((reference - output).abs().max() / reference.abs().max()).item()
+
+
+def psnr(reference, output):
+    mse = torch.mean((reference - output) ** 2).item()
+    peak = (reference.max() - reference.min()).item()
+    return math.inf if mse == 0 else 10 * math.log10(peak ** 2 / mse)
+
+
+def assert_close(reference, output, max_rel, min_psnr):
+    assert output.shape == reference.shape
+    assert relative_error(reference, output) <= max_rel
+    assert psnr(reference, output) >= min_psnr
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_reference_output_shape(model, measure, size):
+    image = synthetic_image(*size, seed=1)
+    with torch.no_grad():
+        output = measure("reference", size, lambda: model(image), ("reference",))
+    assert output.shape == (1, 3, size[1] * 4, size[0] * 4)
+    assert torch.isfinite(output).all()
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_batched_matches_reference(model, measure, size):
+    images = [synthetic_image(*size, seed=seed) for seed in range(3)]
+    with torch.no_grad():
+        references = [model(image) for image in images]
+        batch = measure(
+            "batched x3", size, lambda: model(torch.cat(images)), ("batched", 3)
+        )
+    for reference, output in zip(references, batch):
+        assert_close(reference[0], output, max_rel=1e-5, min_psnr=100)
+
+
+@pytest.mark.parametrize("tile_size", [32, 48])
+@pytest.mark.parametrize("size", SIZES)
+def test_tiled_matches_reference(model, measure, size, tile_size):
+    image = synthetic_image(*size, seed=2)
+    with torch.no_grad():
+        reference = model(image)
+        output = measure(
+            f"tiled {tile_size}",
+            size,
+            lambda: upscale_tiled(model, image, tile_size),
+            ("tiled", tile_size, tile_overlap(model)),
+        )
+    assert_close(reference, output, max_rel=1e-6, min_psnr=120)
+
+
+def test_tiled_with_short_overlap_shows_seams(model):
+    image = synthetic_image(96, 64, seed=2)
+    with torch.no_grad():
+        reference = model(image)
+        output = upscale_tiled(model, image, 32, tile_overlap(model) // 2)
+    assert relative_error(reference, output) > 1e-4
+
+
+def test_tiled_resumes_from_checkpoints(model, tmp_path):
+    image = synthetic_image(96, 64, seed=4)
+    with torch.no_grad():
+        first = upscale_tiled(model, image, 48, checkpoint_dir=str(tmp_path))
+        checkpoints = sorted(tmp_path.glob("*.pt"))
+        assert len(checkpoints) == 4
+
+        # Drop one tile, as if the worker died before finishing it.
+        checkpoints[-1].unlink()
+        calls = []
+        hook = model.register_forward_hook(lambda *args: calls.append(args))
+        try:
+            resumed = upscale_tiled(model, image, 48, checkpoint_dir=str(tmp_path))
+        finally:
+            hook.remove()
+
+    assert len(calls) == 1
+    assert torch.equal(first, resumed)
+
+
+def test_planned_tiles_match_reference(model, measure):
+    size = (256, 192)
+    image = synthetic_image(*size, seed=3)
+    available = math.ceil(
+        estimate_tiled_bytes(model, *size, TILE_SIZES[-1]) / MEMORY_FRACTION
+    )
+    plan = plan_job(model, *size, available=available)
+    assert plan["tile_size"] == TILE_SIZES[-1]
+    assert plan["estimated_peak_bytes"] <= plan["budget_bytes"]
+
+    with torch.no_grad():
+        reference = model(image)
+        output = measure(
+            "planned",
+            size,
+            lambda: upscale_tiled(
+                model, image, plan["tile_size"], plan["tile_overlap"]
+            ),
+            ("tiled", plan["tile_size"], plan["tile_overlap"]),
+        )
+    assert_close(reference, output, max_rel=1e-6, min_psnr=120)
+
+
+def test_plan_batches_when_memory_allows(model):
+    plan = plan_job(model, 24, 24, max_batch_size=4, available=2**34)
+    assert plan["tile_size"] is None
+    assert plan["batch_size"] == 4
@@ -0,0 +1,165 @@
+import sys
+import types
+
+import pytest
+import torch
+from PIL import Image
+
+import worker
+from generator import Generator
+from journal import Journal, JobBroker, open_broker
+
+
+@pytest.fixture
+def broker(tmp_path):
+    broker = Journal(str(tmp_path / "jobs.db"))
+    yield broker
+    broker.close()
+
+
+def queued(**extra):
+    return {"status": "queued", "progress": 0, **extra}
+
+
+def test_claim_takes_oldest_queued_task(broker):
+    broker.enqueue("a", queued())
+    broker.enqueue("b", queued())
+
+    assert [task_id for task_id, _ in broker.claim("w1", 30)] == ["a"]
+    assert [task_id for task_id, _ in broker.claim("w2", 30)] == ["b"]
+    assert broker.claim("w3", 30) == []
+    assert broker.get("a")["status"] == "processing"
+
+
+def test_claim_groups_tasks_from_one_batch(broker):
+    broker.enqueue("a", queued(batch_id="x"))
+    broker.enqueue("b", queued())
+    broker.enqueue("c", queued(batch_id="x"))
+
+    claimed = broker.claim("w1", 30, limit=4)
+    assert [task_id for task_id, _ in claimed] == ["a", "c"]
+
+
+def test_claim_batch_takes_only_the_given_batch(broker):
+    broker.enqueue("a", queued(batch_id="x"))
+    broker.enqueue("b", queued())
+    broker.enqueue("c", queued(batch_id="x"))
+    broker.enqueue("d", queued(batch_id="x"))
+
+    claimed = broker.claim_batch("w1", 30, "x", 2)
+    assert [task_id for task_id, _ in claimed] == ["a", "c"]
+
+
+def test_live_lease_is_not_reclaimed(broker):
+    broker.enqueue("a", queued())
+    broker.claim("w1", 30)
+
+    assert broker.claim("w2", 30) == []
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_is_fenced(broker):
+    broker.enqueue("a", queued())
+    broker.claim("w1", -1)
+
+    claimed = broker.claim("w2", 30)
+    assert [task_id for task_id, _ in claimed] == ["a"]
+
+    _, state = claimed[0]
+    assert not broker.update("a", "w1", {**state, "status": "completed"})
+    assert broker.heartbeat("w1", ["a"], 30) == []
+    assert broker.get("a")["status"] == "processing"
+
+    assert broker.update("a", "w2", {**state, "status": "completed"})
+    assert broker.get("a")["status"] == "completed"
+
+
+def test_heartbeat_extends_only_own_processing_tasks(broker):
+    broker.enqueue("a", queued())
+    broker.enqueue("b", queued())
+    (_, state), = broker.claim("w1", -1)
+
+    assert broker.heartbeat("w1", ["a", "b"], 30) == ["a"]
+    assert [task_id for task_id, _ in broker.claim("w2", 30)] == ["b"]
+
+    broker.update("a", "w1", {**state, "status": "completed"})
+    assert broker.heartbeat("w1", ["a"], 30) == []
+
+
+def test_update_after_forget_does_not_recreate_task(broker):
+    broker.enqueue("a", queued())
+    (_, state), = broker.claim("w1", 30)
+    broker.forget("a")
+
+    assert not broker.update("a", "w1", {**state, "progress": 50})
+    assert broker.get("a") is None
+    assert broker.claim("w2", 30) == []
+
+
+def test_live_leases_counts_only_unexpired_claims(broker):
+    broker.enqueue("a", queued())
+    broker.enqueue("b", queued())
+    assert broker.live_leases() == 0
+
+    broker.claim("w1", -1)
+    assert broker.live_leases() == 0
+
+    broker.claim("w2", 30)
+    assert broker.live_leases() == 1
+
+
+def test_worker_drops_output_after_losing_lease(broker, tmp_path):
+    output_path = tmp_path / "out.png"
+    broker.enqueue("a", queued(output_path=str(output_path)))
+    claimed = broker.claim("w1", -1)
+    broker.claim("w2", 30)
+
+    tasks = worker.Heartbeat(broker, "w1", claimed)
+    worker.save_output(tasks, "a", torch.rand(3, 4, 4))
+
+    assert "a" in tasks.lost
+    assert not output_path.exists()
+    assert list(tmp_path.glob("out.*")) == []
+    assert broker.get("a")["status"] == "processing"
+
+
+def test_open_broker_selects_sqlite_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv("UPSCALED_JOB_BACKEND", raising=False)
+    broker = open_broker(str(tmp_path))
+    assert isinstance(broker, Journal)
+    broker.close()
+
+
+def test_open_broker_rejects_invalid_backends(tmp_path, monkeypatch):
+    class Incomplete(JobBroker):
+        def __init__(self, data_dir):
+            pass
+
+    class NotABroker:
+        def __init__(self, data_dir):
+            pass
+
+    module = types.ModuleType("fake_backends")
+    module.Incomplete = Incomplete
+    module.NotABroker = NotABroker
+    monkeypatch.setitem(sys.modules, "fake_backends", module)
+
+    with pytest.raises(TypeError):
+        open_broker(str(tmp_path), "fake_backends:Incomplete")
+    with pytest.raises(TypeError):
+        open_broker(str(tmp_path), "fake_backends:NotABroker")
+    with pytest.raises(ValueError):
+        open_broker(str(tmp_path), "no-such-backend")
+
+
+@pytest.mark.parametrize("memory_mb, expected", [(100000, 3), (64, 1)])
+def test_claim_limit_follows_plan(broker, tmp_path, monkeypatch, memory_mb, expected):
+    monkeypatch.setenv("UPSCALED_MEMORY_LIMIT_MB", str(memory_mb))
+    monkeypatch.setattr(worker, "BATCH_SIZE", 4)
+    model = Generator(num_residuals=2).eval()
+    for task_id in "abc":
+        input_path = tmp_path / f"{task_id}.png"
+        Image.new("RGB", (256, 192)).save(input_path)
+        broker.enqueue(task_id, queued(batch_id="x", input_path=str(input_path)))
+
+    claimed = worker.claim_tasks(broker, model, "w1")
+    assert len(claimed) == expected
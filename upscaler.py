@@ -2,7 +2,10 @@ import torch
 from torchvision import transforms
 from PIL import Image
 import sys
+import os
+import uuid
 from generator import Generator
+from planner import tile_overlap
 def load_image(image_path):
     image = Image.open(image_path).convert('RGB')
     transform = transforms.ToTensor()
@@ -11,6 +14,35 @@ def save_image(tensor, output_path):
     image = tensor.squeeze().clamp(0, 1).detach().cpu()
     image = transforms.ToPILImage()(image)
     image.save(output_path)
+def upscale_tiled(model, image, tile_size, overlap = None, checkpoint_dir = None):
+    if overlap is None:
+        overlap = tile_overlap(model)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok = True)
+    device = next(model.parameters()).device
+    height, width = image.shape[-2:]
+    output = None
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            bottom, right = min(top + tile_size, height), min(left + tile_size, width)
+            checkpoint = checkpoint_dir and os.path.join(checkpoint_dir, f"{tile_size}_{top}_{left}.pt")
+            if checkpoint and os.path.exists(checkpoint):
+                sr_piece = torch.load(checkpoint)
+            else:
+                pad_top, pad_left = min(overlap, top), min(overlap, left)
+                tile = image[..., top - pad_top:min(bottom + overlap, height), left - pad_left:min(right + overlap, width)]
+                sr_tile = model(tile.to(device)).cpu()
+                scale = sr_tile.shape[-1] // tile.shape[-1]
+                sr_piece = sr_tile[..., pad_top * scale:(pad_top + bottom - top) * scale, pad_left * scale:(pad_left + right - left) * scale].clone()
+                if checkpoint:
+                    partial = f"{checkpoint}.{uuid.uuid4().hex}"
+                    torch.save(sr_piece, partial)
+                    os.replace(partial, checkpoint)
+            scale = sr_piece.shape[-1] // (right - left)
+            if output is None:
+                output = sr_piece.new_zeros(image.shape[:-3] + (sr_piece.shape[-3], height * scale, width * scale))
+            output[..., top * scale:bottom * scale, left * scale:right * scale] = sr_piece
+    return output
 def upscale_image(input_path, output_path, model_path = "generator.pth"):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = Generator().to(device)
@@ -0,0 +1,197 @@
+import os
+import shutil
+import socket
+import threading
+import traceback
+import uuid
+
+import torch
+
+from generator import Generator
+from journal import open_broker
+from planner import configure_threads, plan_job, read_dimensions
+from upscaler import load_image, save_image, upscale_tiled
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get("UPSCALED_DATA_DIR") or BASE_DIR
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints")
+LEASE_SECONDS = float(os.environ.get("UPSCALED_LEASE_SECONDS", "30"))
+POLL_INTERVAL = float(os.environ.get("UPSCALED_POLL_INTERVAL", "0.5"))
+BATCH_SIZE = int(os.environ.get("UPSCALED_BATCH_SIZE", "4"))
+
+
+def load_model(model_path=os.path.join(BASE_DIR, "generator.pth")):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = Generator(scale_factor=4).to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    return model
+
+
+class Heartbeat:
+    def __init__(self, broker, owner, claimed):
+        self.broker = broker
+        self.owner = owner
+        self.states = dict(claimed)
+        self.lost = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def update(self, task_id, **fields):
+        if task_id in self.lost:
+            return False
+        state = {**self.states[task_id], **fields}
+        if not self.broker.update(task_id, self.owner, state):
+            self.lost.add(task_id)
+            return False
+        self.states[task_id] = state
+        return True
+
+    def pending(self, task_ids):
+        return [
+            task_id
+            for task_id in task_ids
+            if task_id not in self.lost
+            and self.states[task_id]["status"] == "processing"
+        ]
+
+    def _run(self):
+        while not self._stop.wait(LEASE_SECONDS / 3):
+            try:
+                pending = self.pending(list(self.states))
+                held = self.broker.heartbeat(self.owner, pending, LEASE_SECONDS)
+                self.lost.update(set(pending) - set(held))
+            except Exception:
+                traceback.print_exc()
+
+
+def save_output(tasks, task_id, sr_tensor):
+    if not tasks.update(task_id, progress=75):
+        return
+    output_path = tasks.states[task_id]["output_path"]
+    root, extension = os.path.splitext(output_path)
+    partial_path = f"{root}.{tasks.owner}{extension}"
+    save_image(sr_tensor, partial_path)
+    if task_id in tasks.lost:
+        os.remove(partial_path)
+        return
+    os.replace(partial_path, output_path)
+    tasks.update(task_id, status="completed", progress=100)
+
+
+def plan_task(model, state, plans=None):
+    size = read_dimensions(state["input_path"])
+    plans = {} if plans is None else plans
+    if size not in plans:
+        plans[size] = plan_job(model, *size, max_batch_size=BATCH_SIZE)
+    return plans[size]
+
+
+def process_tasks(broker, model, owner, claimed):
+    device = next(model.parameters()).device
+
+    with Heartbeat(broker, owner, claimed) as tasks:
+        plans = {}
+        groups = {}
+        for task_id, state in claimed:
+            try:
+                plan = plan_task(model, state, plans)
+                if tasks.update(task_id, progress=25, plan=plan):
+                    groups.setdefault((plan["width"], plan["height"]), []).append(
+                        task_id
+                    )
+            except Exception as e:
+                tasks.update(task_id, status="error", progress=0, error=str(e))
+
+        for task_ids in groups.values():
+            plan = tasks.states[task_ids[0]]["plan"]
+            for start in range(0, len(task_ids), plan["batch_size"]):
+                chunk = task_ids[start:start + plan["batch_size"]]
+                try:
+                    chunk = [
+                        task_id for task_id in chunk if tasks.update(task_id, progress=50)
+                    ]
+                    if not chunk:
+                        continue
+                    # Decode only the images about to run, so the planned
+                    # budget is not eaten by inputs still waiting their turn.
+                    batch = torch.cat(
+                        [load_image(tasks.states[task_id]["input_path"]) for task_id in chunk]
+                    )
+                    with torch.no_grad():
+                        if plan["tile_size"]:
+                            # Tiled jobs are large and run one image at a time.
+                            # Finished tiles are kept so a retry resumes them.
+                            sr_batch = upscale_tiled(
+                                model,
+                                batch,
+                                plan["tile_size"],
+                                plan["tile_overlap"],
+                                checkpoint_dir=os.path.join(CHECKPOINT_DIR, chunk[0]),
+                            )
+                        else:
+                            sr_batch = model(batch.to(device))
+                    del batch
+
+                    for task_id, sr_tensor in zip(chunk, sr_batch):
+                        save_output(tasks, task_id, sr_tensor)
+
+                except Exception as e:
+                    for task_id in tasks.pending(chunk):
+                        tasks.update(task_id, status="error", progress=0, error=str(e))
+
+                for task_id in chunk:
+                    # A worker that took over the lease may still need them.
+                    if task_id not in tasks.lost:
+                        shutil.rmtree(
+                            os.path.join(CHECKPOINT_DIR, task_id), ignore_errors=True
+                        )
+
+
+def claim_tasks(broker, model, owner):
+    claimed = broker.claim(owner, LEASE_SECONDS)
+    if not claimed:
+        return claimed
+
+    _, state = claimed[0]
+    try:
+        batch_size = plan_task(model, state)["batch_size"]
+    except Exception:
+        batch_size = 1
+    if batch_size > 1:
+        claimed += broker.claim_batch(
+            owner, LEASE_SECONDS, state.get("batch_id"), batch_size - 1
+        )
+    return claimed
+
+
+def run_worker(broker, model, stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            owner = uuid.uuid4().hex
+            claimed = claim_tasks(broker, model, owner)
+            if claimed:
+                process_tasks(broker, model, owner, claimed)
+                continue
+        except Exception:
+            traceback.print_exc()
+        stop_event.wait(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    model = load_model()
+    configure_threads()
+    print(f"Worker {socket.gethostname()}:{os.getpid()} polling {DATA_DIR}")
+    try:
+        run_worker(open_broker(DATA_DIR), model)
+    except KeyboardInterrupt:
+        pass